@@ -5,10 +5,28 @@ __prog_name__ = 'ytani_tcpcmd'
 __version__ = '0.0.0'
 __author__ = 'Yoichi Tanibayashi'
 
-from .server import server
-from .client import client
+import importlib
+import sys
 from .my_logger import get_logger
 
 all = ['server',
        'client',
        'get_logger', __prog_name__, __version__, __author__]
+
+
+def __getattr__(name):
+    """ import `server` and `client` commands on first access """
+    if name in ('server', 'client'):
+        importlib.import_module('.' + name, __name__)
+
+        # importing a submodule binds it as the package attribute
+        # (and `client` imports `server`, too);
+        # rebind every loaded one to its command
+        for sub in ('server', 'client'):
+            mod = sys.modules.get(__name__ + '.' + sub)
+            if mod is not None:
+                globals()[sub] = getattr(mod, sub)
+
+        return globals()[name]
+
+    raise AttributeError('module %r has no attribute %r' % (__name__, name))
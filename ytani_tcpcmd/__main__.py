@@ -1,13 +1,29 @@
 #
 # Copyright (c) 2021 Yoichi Tanibayashi
 #
+import importlib
 import click
-from . import server, client
 from . import __prog_name__, __version__, __author__
 from .my_logger import get_logger
 
 
-@click.group(invoke_without_command=True,
+class LazyGroup(click.Group):
+    """ import a subcommand module only when it is used """
+
+    SUBCMDS = ['server', 'client']
+
+    def list_commands(self, ctx):
+        return self.SUBCMDS
+
+    def get_command(self, ctx, cmd_name):
+        if cmd_name not in self.SUBCMDS:
+            return None
+
+        mod = importlib.import_module('.' + cmd_name, __package__)
+        return getattr(mod, cmd_name)
+
+
+@click.group(cls=LazyGroup, invoke_without_command=True,
              context_settings=dict(help_option_names=['-h', '--help']),
              help=" by " + __author__)
 @click.option('--debug', '-d', 'debug', is_flag=True, default=False,
@@ -27,8 +43,5 @@ def cli(ctx, debug):
         print(ctx.get_help())
 
 
-cli.add_command(server)
-cli.add_command(client)
-
 if __name__ == '__main__':
     cli(prog_name=__prog_name__)
@@ -2,8 +2,10 @@
 # Copyright (c) 2021 Yoichi Tanibayashi
 #
 import click
-import time
-import telnetlib
+import selectors
+import socket
+import sys
+from logging import DEBUG
 from .server import Server
 from .my_logger import get_logger
 
@@ -13,16 +15,29 @@ class Client:
 
     __log = get_logger(__name__, False)
 
+    DEF_RECV_TIMEOUT = 2.0  # sec: wait for the first byte
+    DEF_DRAIN_TIMEOUT = 0.1  # sec: wait for the opening in first send()
+    RECV_IDLE_TIMEOUT = 0.05  # sec: no more data .. end of burst
+    AFTERBURN = 1000  # non-blocking polls after data arrived
+    RECV_BUFSIZE = 65536  # bytes per recv()
+
     def __init__(self, svr_host, svr_port, debug=False):
         """ init """
         self._dbg = debug
-        __class__.__log = get_logger(__class__.__name__, self._dbg)
+        self.__log = get_logger(__class__.__name__, self._dbg)
         self.__log.debug('(svr_host, svr_port) = %s', (svr_host, svr_port))
 
         self._svr_host = svr_host
         self._svr_port = svr_port
 
-        self._tn = telnetlib.Telnet(self._svr_host, self._svr_port)
+        self._sock = socket.create_connection((self._svr_host,
+                                               self._svr_port))
+        self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        self._sel = selectors.DefaultSelector()
+        self._sel.register(self._sock, selectors.EVENT_READ)
+
+        self._drained = False  # the opening message has been read
 
     def end(self):
         """ end """
@@ -32,47 +47,74 @@ class Client:
     def close(self):
         """ close """
         self.__log.debug('')
-        self._tn.close()
+        self._sel.close()
+        try:
+            self._sock.shutdown(socket.SHUT_RDWR)
+        except OSError as ex:
+            self.__log.debug('%s:%s', type(ex).__name__, ex)
+        self._sock.close()
 
     def send(self, arg_str):
-        """ send """
+        """ send
+
+        only the first send() on the connection waits for the opening
+        message; it returns '' after that
+        """
         self.__log.debug('arg_str=%a', arg_str)
 
-        ret = '_'
         opening = ''
-        while len(ret) > 0:
-            ret = self.recv()
-            opening += ret
+        if not self._drained:
+            opening = self.recv(self.DEF_DRAIN_TIMEOUT)
+            self._drained = True
 
         self.__log.debug('opening=%a', opening)
 
         try:
-            self._tn.write(arg_str.encode('utf-8'))
+            self._sock.sendall(arg_str.encode('utf-8'))
             self.__log.debug('sent: %a', arg_str)
         except Exception as ex:
             self.__log.warning('%s:%s', type(ex).__name__, ex)
 
         return opening
 
-    def recv(self):
-        """ recv """
-        self.__log.debug('')
-
-        buf = b''
-        while True:
-            time.sleep(0.1)
-            try:
-                in_data = self._tn.read_eager()
-            except Exception as ex:
-                self.__log.warning('%s:%s', type(ex).__name__, ex)
-                in_data = b''
-
-            if len(in_data) == 0:
-                break
-
-            self.__log.debug('in_data=%a', in_data)
-            buf += in_data
-
+    def recv(self, timeout=DEF_RECV_TIMEOUT):
+        """ recv
+
+        Wait up to `timeout` sec for the first byte.
+        Once data has arrived, keep polling without waiting
+        (afterburn: up to AFTERBURN empty polls) for the rest of
+        the burst, then wait up to RECV_IDLE_TIMEOUT for more.
+        """
+        self.__log.debug('timeout=%s', timeout)
+
+        dbg = self.__log.isEnabledFor(DEBUG)
+        chunks = []
+        eof = False
+        while not eof and self._sel.select(timeout):
+            spins = 0
+            while spins < self.AFTERBURN:
+                try:
+                    in_data = self._sock.recv(self.RECV_BUFSIZE,
+                                              socket.MSG_DONTWAIT)
+                except BlockingIOError:
+                    spins += 1
+                    continue
+                except Exception as ex:
+                    self.__log.warning('%s:%s', type(ex).__name__, ex)
+                    in_data = b''
+
+                if len(in_data) == 0:
+                    eof = True
+                    break
+
+                if dbg:
+                    self.__log.debug('in_data=%a', in_data)
+                chunks.append(in_data)
+                spins = 0
+
+            timeout = self.RECV_IDLE_TIMEOUT
+
+        buf = b''.join(chunks)
         self.__log.debug('buf=%a', buf)
         try:
             ret_str = buf.decode('utf-8')
@@ -93,14 +135,15 @@ class ClientApp:
     __log = get_logger(__name__, False)
 
     def __init__(self, svr_host="localhost", svr_port=Server.DEF_PORT,
-                 arg_str="", debug=False):
+                 arg_str="", batch=False, debug=False):
         """ __init__ """
         self._dbg = debug
-        __class__.__log = get_logger(__class__.__name__, self._dbg)
+        self.__log = get_logger(__class__.__name__, self._dbg)
         self.__log.debug('(svr_host, svr_port)=%s', (svr_host, svr_port))
-        self.__log.debug('arg_str=%a', arg_str)
+        self.__log.debug('arg_str=%a, batch=%s', arg_str, batch)
 
         self._arg_str = arg_str
+        self._batch = batch
         self._svr_host = svr_host
         self._svr_port = svr_port
 
@@ -109,6 +152,11 @@ class ClientApp:
     def main(self):
         """ main """
         self.__log.debug('')
+
+        if self._batch:
+            self.batch()
+            return
+
         opening = self._cl_obj.send(self._arg_str)
         print('opening=%a' % opening)
 
@@ -117,6 +165,26 @@ class ClientApp:
         reply = self._cl_obj.recv()
         print('reply=%a' % reply)
 
+    def batch(self):
+        """ batch
+
+        send commands read from stdin (one per line)
+        over the same connection
+        """
+        self.__log.debug('')
+
+        for line in sys.stdin:
+            arg_str = line.strip()
+            if len(arg_str) == 0:
+                continue
+
+            opening = self._cl_obj.send(arg_str)
+            if len(opening) > 0:
+                print('opening=%a' % opening)
+
+            reply = self._cl_obj.recv()
+            print('reply=%a' % reply)
+
     def end(self):
         """ end """
         self.__log.debug('')
@@ -130,19 +198,21 @@ class ClientApp:
 @click.option('--svr_port', '-p', 'svr_port', type=int,
               default=Server.DEF_PORT,
               help='server port number (default: %s)' % (Server.DEF_PORT))
+@click.option('--batch', '-b', 'batch', is_flag=True, default=False,
+              help='send stdin lines over one connection')
 @click.option('--debug', '-d', 'debug', is_flag=True, default=False,
               help='debug flag')
 @click.pass_obj
-def client(obj, arg, svr_host, svr_port, debug):
+def client(obj, arg, svr_host, svr_port, batch, debug):
     """ Client """
     debug = obj['debug'] or debug
     __log = get_logger(__name__, debug)
-    __log.debug('obj=%s, arg=%s, svr_host=%s, svr_port=%s',
-                obj, arg, svr_host, svr_port)
+    __log.debug('obj=%s, arg=%s, svr_host=%s, svr_port=%s, batch=%s',
+                obj, arg, svr_host, svr_port, batch)
 
     arg_str = ' '.join(arg)
 
-    obj = ClientApp(svr_host, svr_port, arg_str, debug=debug)
+    obj = ClientApp(svr_host, svr_port, arg_str, batch, debug=debug)
     try:
         obj.main()
     finally:
@@ -7,6 +7,7 @@ my_logger.py
 __author__ = 'Yoichi Tanibayashi'
 __date__ = '2021'
 
+import functools
 import inspect
 from logging import getLogger, StreamHandler, Formatter
 from logging import DEBUG, INFO
@@ -22,29 +23,39 @@ CONSOLE_HANDLER.setFormatter(HANDLER_FMT)
 CONSOLE_HANDLER.setLevel(DEBUG)
 
 
-def get_logger(name, dbg=False):
+@functools.lru_cache(maxsize=None)
+def _setup_logger(name):
     """
-    get logger
+    create and set up the logger only once per name
     """
-    filename = inspect.stack()[1].filename.split('/')[-1]
-    name = filename + '.' + name
     logger = getLogger(name)
     logger.propagate = False
     logger.addHandler(CONSOLE_HANDLER)
-    logger.setLevel(INFO)
+    return logger
+
+
+def get_logger(name, dbg=False):
+    """
+    get logger
+    """
+    filename = inspect.currentframe().f_back.f_code.co_filename
+    name = filename.split('/')[-1] + '.' + name
+    logger = _setup_logger(name)
 
     # [Important !! ]
     # isinstance()では、boolもintと判定されるので、
     # 先に bool かどうかを判定する
 
     if isinstance(dbg, bool):
-        if dbg:
-            logger.setLevel(DEBUG)
-
-        return logger
-
-    if isinstance(dbg, int):
-        logger.setLevel(dbg)
-        return logger
-
-    raise ValueError('invalid `dbg` value: %s' % (dbg))
+        level = DEBUG if dbg else INFO
+    elif isinstance(dbg, int):
+        level = dbg
+    else:
+        raise ValueError('invalid `dbg` value: %s' % (dbg))
+
+    # setLevel() clears the cache of all loggers under the module lock:
+    # call it only when the level actually changes
+    if logger.level != level:
+        logger.setLevel(level)
+
+    return logger
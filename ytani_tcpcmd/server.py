@@ -1,84 +1,30 @@
 #
 # Copyright (c) 2021 Yoichi Tanibayashi
 #
+import concurrent.futures
+import functools
+import os
+import signal
+import socket
 import socketserver
 import sys
 import threading
-import queue
 import time
+from logging import DEBUG
 import click
 from .my_logger import get_logger
 
+# コントロールキャラクター(0x00-0x1f) 削除用
+_CTRL_DELETE = bytes(range(0x20))
 
-class Worker(threading.Thread):
-    """ Worker """
+# 送信メッセージ
+_READY = b'# Ready\r\n'
+_CRLF = b'\r\n'
+_NODATA_MSG = b'# No data .. disconnect\r\n'
+_BUSY_MSG = b'# Server busy .. disconnect\r\n'
 
-    __log = get_logger(__name__, False)
-
-    DEF_RECV_TIMEOUT = 0.2  # sec
-
-    def __init__(self, svr, debug=False):
-        self._dbg = debug
-        self.__log = get_logger(__class__.__name__, self._dbg)
-        self.__log.debug('')
-
-        self._svr = svr
-
-        self._cmdq = queue.Queue()
-        self._active = False
-
-        super().__init__(daemon=True)
-
-    def __del__(self):
-        """ __del__ """
-        self._active = False
-        self.__log.debug('')
-
-    def end(self):
-        """ end """
-        self.__log.debug('')
-        self._active = False
-        self.join()
-        self.__log.debug('done')
 
-    def send(self, cmd):
-        """ send """
-        self.__log.debug('cmd=%a', cmd)
-
-        self._cmdq.put(cmd)
-
-    def recv(self, timeout=DEF_RECV_TIMEOUT):
-        """ recv """
-        # self.__log.debug('timeout=%.1f', timeout)
-
-        try:
-            cmd = self._cmdq.get(timeout=timeout)
-        except queue.Empty:
-            cmd = ''
-        else:
-            self.__log.debug('cmd=%a', cmd)
-
-        return cmd
-
-    def run(self):
-        """ run """
-
-        self._active = True
-        while self._active:
-            cmd = self.recv()
-
-            if cmd == '':
-                time.sleep(0.1)
-                continue
-
-            self.__log.debug('cmd=%a', cmd)
-
-            time.sleep(3)
-
-        self.__log.debug('done')
-
-
-class Handler(socketserver.StreamRequestHandler):
+class Handler(socketserver.BaseRequestHandler):
     """ Handler """
 
     __log = get_logger(__name__, False)
@@ -90,13 +36,13 @@ class Handler(socketserver.StreamRequestHandler):
         self.__log.debug('client_address: %s', client_address)
 
         self._svr = svr
-        self._worker = self._svr._worker
 
         return super().__init__(request, client_address, svr)
 
     def setup(self):
         """ setup """
         self.__log.debug('')
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         return super().setup()
 
     def finish(self):
@@ -105,10 +51,11 @@ class Handler(socketserver.StreamRequestHandler):
 
     def net_write(self, msg):
         """ net_write """
-        self.__log.debug('msg=%a', msg)
+        if self.__log.isEnabledFor(DEBUG):
+            self.__log.debug('msg=%a', msg)
 
         try:
-            self.wfile.write(msg)
+            self.request.sendall(msg)
         except BrokenPipeError as ex:
             self.__log.debug('%s:%s', type(ex).__name__, ex)
         except Exception as ex:
@@ -126,15 +73,17 @@ class Handler(socketserver.StreamRequestHandler):
         #  0x22 LINEMODE
         # self.net_write(b'\xff\xfd\x22')
 
-        self.net_write('# Ready\r\n'.encode('utf-8'))
+        self.net_write(_READY)
 
+        dbg = self.__log.isEnabledFor(DEBUG)
         net_data = b''
 
         while self._svr._active:
             # データー受信
             try:
-                self.__log.debug('recv..')
-                net_data = self.request.recv(512)
+                if dbg:
+                    self.__log.debug('recv..')
+                net_data = self.request.recv(4096)
             except ConnectionResetError as ex:
                 self.__log.warning('%s:%s.', type(ex), ex)
                 return
@@ -146,54 +95,71 @@ class Handler(socketserver.StreamRequestHandler):
                 self.__log.warning('Exception:%s:%s.', type(ex), ex)
                 break
             else:
-                self.__log.debug('net_data:%a', net_data)
+                if dbg:
+                    self.__log.debug('net_data:%a', net_data)
 
-            # デコード(UTF-8)
-            try:
-                decoded_data = net_data.decode('utf-8')
-            except UnicodeDecodeError as ex:
-                self.__log.warning('%s:%s .. ignored', type(ex), ex)
-                continue
-            else:
-                self.__log.debug('decoded_data:%a', decoded_data)
+            if not self._svr._active:
+                # Server.end() で切断された
+                break
 
-            # self.net_write('\r\n'.encode('utf-8'))
+            # self.net_write(_CRLF)
 
-            # 文字列抽出(コントロールキャラクター削除)
-            data = ''
-            for ch in decoded_data:
-                if ord(ch) >= 0x20:
-                    data += ch
-            self.__log.debug('data=%a', data)
+            # コントロールキャラクター削除
+            net_data = net_data.translate(None, _CTRL_DELETE)
 
             # 文字数が0の場合、コネクションが切断されたと判断し終了
-            if len(data) == 0:
-                msg = '# No data .. disconnect'
-                self.__log.warning(msg)
-                self.net_write((msg + '\r\n').encode('utf-8'))
+            # (デコード前に判定)
+            if len(net_data) == 0:
+                self.__log.warning('# No data .. disconnect')
+                self.net_write(_NODATA_MSG)
                 break
 
-            self._worker.send(data)
+            # デコード(UTF-8)
+            data = net_data.decode('utf-8', errors='replace')
+            if dbg:
+                self.__log.debug('data=%a', data)
+
+            self._svr._pool.submit(self._svr.dispatch, data)
 
         self.__log.debug('done')
 
 
-class Server(socketserver.ThreadingTCPServer):
-    """ Server """
+class Server(socketserver.TCPServer):
+    """ Server
+
+    connections are handled on a bounded thread pool
+    instead of a new thread per connection.
+
+    each connection holds a thread until it is closed, so
+    `max_handlers` is the number of simultaneous connections;
+    the ones over it get `_BUSY_MSG` and are closed.
+    """
 
     __log = get_logger(__name__, False)
 
     DEF_PORT = 12345
 
-    def __init__(self, port=DEF_PORT, debug=False):
+    DEF_MAX_HANDLERS = 64  # simultaneous connections
+    THREAD_STACK_SIZE = 256 * 1024  # bytes
+
+    def __init__(self, port=DEF_PORT, reuse_port=False,
+                 max_handlers=DEF_MAX_HANDLERS, debug=False):
         self._dbg = debug
-        __class__.__log = get_logger(__class__.__name__, self._dbg)
-        self.__log.debug('port=%s', port)
+        self.__log = get_logger(__class__.__name__, self._dbg)
+        self.__log.debug('port=%s, reuse_port=%s, max_handlers=%s',
+                         port, reuse_port, max_handlers)
 
         self._port = port
-
-        self._worker = Worker(svr=self, debug=self._dbg)
+        self._reuse_port = reuse_port
+        self._max_handlers = max_handlers
+
+        threading.stack_size(self.THREAD_STACK_SIZE)
+        self._handler_pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self._max_handlers, thread_name_prefix='handler')
+        self._pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=os.cpu_count() or 4, thread_name_prefix='cmd')
         self._active = False
+        self._requests = set()  # 接続中のソケット (process_request()で登録)
 
         self.allow_reuse_address = True  # Important !!
 
@@ -204,11 +170,86 @@ class Server(socketserver.ThreadingTCPServer):
             sys.exit()
             # return None
 
+    def server_bind(self):
+        """ server_bind
+
+        with `reuse_port`, several processes can listen on the same port
+        and the kernel distributes incoming connections among them.
+        """
+        if self._reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        return super().server_bind()
+
+    def process_request(self, request, client_address):
+        """ process_request
+
+        run the Handler on a thread of `self._handler_pool`
+        """
+        if len(self._requests) >= self._max_handlers:
+            # 空きスレッドがない: 待たせずに切断する
+            self.__log.warning('%s: server busy .. disconnect',
+                               client_address)
+            try:
+                request.sendall(_BUSY_MSG)
+            except OSError as ex:
+                self.__log.debug('%s:%s', type(ex).__name__, ex)
+            self.shutdown_request(request)
+            return
+
+        # Handler のスレッドが動き出す前に登録しておく
+        # (end()で、すべての接続の recv()を終了させるため)
+        self._requests.add(request)
+        try:
+            fut = self._handler_pool.submit(self.process_request_thread,
+                                            request, client_address)
+            fut.add_done_callback(
+                functools.partial(self._request_cancelled, request))
+        except BaseException:
+            # submit()の途中で KeyboardInterrupt などが発生した場合、
+            # スレッドが既に recv()で待っている可能性があるので、
+            # 呼び出し元で close()される前に、recv()を終了させる
+            self._requests.discard(request)
+            try:
+                request.shutdown(socket.SHUT_RDWR)
+            except OSError as ex:
+                self.__log.debug('%s:%s', type(ex).__name__, ex)
+            raise
+
+    def _request_cancelled(self, request, fut):
+        """ _request_cancelled
+
+        close the request whose Handler was cancelled
+        (end() with `cancel_futures`) before it started
+        """
+        if fut.cancelled():
+            self._requests.discard(request)
+            self.shutdown_request(request)
+
+    def process_request_thread(self, request, client_address):
+        """ process_request_thread (same as ThreadingMixIn) """
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self._requests.discard(request)
+            self.shutdown_request(request)
+
+    def dispatch(self, cmd):
+        """ dispatch
+
+        run on a thread of `self._pool`
+        """
+        self.__log.debug('cmd=%a', cmd)
+
+        time.sleep(3)
+
+        self.__log.debug('done')
+
     def serve_forever(self, poll_interval=0.5):
         """  serve_forever """
         self.__log.debug('')
         self._active = True
-        self._worker.start()
         return super().serve_forever(poll_interval)
 
     def end(self):
@@ -217,15 +258,19 @@ class Server(socketserver.ThreadingTCPServer):
 
         self._active = False
         self.shutdown()
-        if self._worker._active:
-            self._worker.end()
+        self.server_close()
 
-        self.__log.debug('done')
+        # 接続中の Handler の recv() を終了させる
+        for request in list(self._requests):
+            try:
+                request.shutdown(socket.SHUT_RDWR)
+            except OSError as ex:
+                self.__log.debug('%s:%s', type(ex).__name__, ex)
 
-        # TBD
-        # 接続中の Handler を強制終了するためにこのようにしているが、
-        # もっといい方法がないのか?
-        raise KeyboardInterrupt  # TBD ??
+        self._handler_pool.shutdown(wait=False, cancel_futures=True)
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+        self.__log.debug('done')
 
     def __del__(self):
         self.__log.debug('')
@@ -238,40 +283,139 @@ class ServerApp:
 
     __log = get_logger(__name__, False)
 
-    def __init__(self, port, debug=False):
+    CHILD_EXIT_TIMEOUT = 5.0  # sec: wait for children after each signal
+
+    def __init__(self, port, procs=1,
+                 max_handlers=Server.DEF_MAX_HANDLERS, debug=False):
         """ init """
         self._dbg = debug
-        __class__.__log = get_logger(__class__.__name__, self._dbg)
-        self.__log.debug('port=%s', port)
+        self.__log = get_logger(__class__.__name__, self._dbg)
+        self.__log.debug('port=%s, procs=%s, max_handlers=%s',
+                         port, procs, max_handlers)
 
         self._port = port
-        self._svr = Server(self._port, debug=self._dbg)
+        self._procs = procs
+        self._max_handlers = max_handlers
+
+        self._children = []
+        self._svr = None
 
     def main(self):
-        """ main """
+        """ main
+
+        with `procs` > 1, fork (procs - 1) child processes.
+        each process has its own Server listening on the same port
+        (SO_REUSEPORT) and is pinned to one CPU.
+        """
+        self.__log.debug('')
+
+        # SIGTERM でも、end()で子プロセスなどを終了させる
+        # (SystemExit で、呼び出し元の finally に抜ける)
+        signal.signal(signal.SIGTERM, self._sigterm)
+
+        idx = 0
+        for i in range(1, self._procs):
+            pid = os.fork()
+            if pid == 0:
+                # child process
+                self._children = []
+                idx = i
+                break
+
+            self._children.append(pid)
+
+        if self._procs > 1 and hasattr(os, 'sched_setaffinity'):
+            cpus = sorted(os.sched_getaffinity(0))
+            os.sched_setaffinity(0, {cpus[idx % len(cpus)]})
+
+        self._svr = Server(self._port, reuse_port=self._procs > 1,
+                           max_handlers=self._max_handlers, debug=self._dbg)
+
         self.__log.debug('start server')
         self._svr.serve_forever()
 
     def end(self):
-        """ end """
+        """ end
+
+        stop the child processes: SIGINT, then SIGTERM, then SIGKILL
+        to the ones still alive after `CHILD_EXIT_TIMEOUT` sec
+        """
         self.__log.debug('')
-        self._svr.end()
+
+        # 終了処理中は SIGINT を無視する
+        # (Ctrl-C はプロセスグループ全体に届くので、
+        #  二度目の SIGINT で終了処理が中断されないように)
+        # SIGTERM は、デフォルト(即終了)に戻す
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+        for sig in (signal.SIGINT, signal.SIGTERM, signal.SIGKILL):
+            self._reap_children(0)
+            for pid in self._children:
+                try:
+                    os.kill(pid, sig)
+                except OSError as ex:
+                    self.__log.debug('%s:%s', type(ex).__name__, ex)
+            self._reap_children(self.CHILD_EXIT_TIMEOUT)
+            if not self._children:
+                break
+
+            self.__log.warning('%s: still alive after %s',
+                               self._children, sig.name)
+
+        if self._svr is not None:
+            self._svr.end()
+
         self.__log.debug('done')
 
+    def _sigterm(self, signum, frame):
+        """ _sigterm """
+        self.__log.info('signal %s', signum)
+        raise SystemExit(128 + signum)
+
+    def _reap_children(self, timeout):
+        """ _reap_children
+
+        wait up to `timeout` sec for the children to exit
+        and remove the exited ones from `self._children`
+        """
+        deadline = time.monotonic() + timeout
+
+        while True:
+            for pid in list(self._children):
+                try:
+                    done, _ = os.waitpid(pid, os.WNOHANG)
+                except ChildProcessError:
+                    done = pid
+                if done != 0:
+                    self._children.remove(pid)
+
+            if not self._children or time.monotonic() >= deadline:
+                return
+
+            time.sleep(0.05)
+
 
 @click.command(help="TCP Command Server")
 @click.option('--port', '-p', 'port', type=int, default=Server.DEF_PORT,
               help='port number (default: %s)' % (Server.DEF_PORT))
+@click.option('--procs', '-n', 'procs', type=int, default=1,
+              help='number of server processes (default: 1)')
+@click.option('--max_handlers', '-m', 'max_handlers', type=int,
+              default=Server.DEF_MAX_HANDLERS,
+              help='max connections per process (default: %s)' % (
+                  Server.DEF_MAX_HANDLERS))
 @click.option('--debug', '-d', 'debug', is_flag=True, default=False,
               help='debug flag')
 @click.pass_obj
-def server(obj, port, debug):
+def server(obj, port, procs, max_handlers, debug):
     """ Server """
     debug = obj['debug'] or debug
     __log = get_logger(__name__, debug)
-    __log.debug('obj=%s, port=%s', obj, port)
+    __log.debug('obj=%s, port=%s, procs=%s, max_handlers=%s',
+                obj, port, procs, max_handlers)
 
-    obj = ServerApp(port, debug=debug)
+    obj = ServerApp(port, procs, max_handlers, debug=debug)
     try:
         obj.main()
     finally:
@@ -24,7 +24,9 @@ CmdServerHandler で即時に実行される関数(func_i)と、
 登録できる。
 
 func_i: 複数クライアントからの要求が並列実行される(マルチスレッド)。
-func_q: 並列実行されず、必ず順に一つずつ実行される(シングルスレッド)。
+func_q: 通常は並列実行されず、必ず順に一つずつ実行される(シングルスレッド)。
+        ただし、add_cmd(.., concurrent=True) で登録したコマンドの
+        func_q は、スレッドプールで並列実行される (sleep など)。
 
 
 オブジェクト
@@ -48,11 +50,16 @@ main() - CmdServerApp:main() - Cmd.main()
            |   +- CmdServerHandler.handle()
            |
            +- CmdServerApp.cmd_worker()
+               |
+               +- CmdServerApp.call_func_q() (concurrent=True のコマンド)
 
 """
 
 import socketserver
 import socket
+import sys
+import concurrent.futures
+import functools
 import threading
 import queue
 import json
@@ -60,6 +67,31 @@ import time
 
 from .my_logger import get_logger
 
+_CRLF = b'\r\n'
+_EOF = b'\x04'
+
+
+def _is_json_plain(s):
+    """
+    json.dumps()で、エスケープ不要な文字列か?
+    (印字可能な ASCII文字のみで、'"' と '\\' を含まない)
+    """
+    return (isinstance(s, str) and s.isascii() and s.isprintable()
+            and '"' not in s and '\\' not in s)
+
+
+class CmdEntry:
+    """
+    コマンドテーブルのエントリー (Cmd.add_cmd()で登録)
+    """
+    __slots__ = ('func_i', 'func_q', 'help', 'concurrent')
+
+    def __init__(self, func_i, func_q, help_str, concurrent=False):
+        self.func_i = func_i
+        self.func_q = func_q
+        self.help = help_str
+        self.concurrent = concurrent  # True: func_q を並行実行してよい
+
 
 class Cmd:
     """
@@ -72,17 +104,21 @@ class Cmd:
         :
         return rc, msg
 
+    func_q は、通常 cmd_worker で一つずつ逐次実行される。
+    add_cmd(.., concurrent=True) としたコマンドの func_q は、
+    スレッドプールで並行に実行される (sleep など、待つだけのもの)。
+
     コマンド実行以外の処理は、main(), end()を override
       self._active をフラグとして利用
 
     """
     DEF_PORT = 59001
 
-    RC_OK = 'OK'  # OK .. FUNC_I の場合は、キューイング不要
-    RC_NG = 'NG'  # NG
-    RC_CONT = 'CONTINUE'  # FUNC_I 正常終了 .. キューイングして結果を待つ
-    RC_ACCEPT = 'ACCEPT'  # FUNC_I 正常終了 .. キューイングして結果を待たない
-    RC_NONE = 'NONE'  # FUNC_Q .. 返信を返さない
+    RC_OK = sys.intern('OK')  # OK .. FUNC_I の場合は、キューイング不要
+    RC_NG = sys.intern('NG')  # NG
+    RC_CONT = sys.intern('CONTINUE')  # FUNC_I 正常終了 .. キューイングして結果を待つ
+    RC_ACCEPT = sys.intern('ACCEPT')  # FUNC_I 正常終了 .. キューイングして結果を待たない
+    RC_NONE = sys.intern('NONE')  # FUNC_Q .. 返信を返さない
 
     CMD_HELP = 'help'
     CMD_EXIT = 'exit'
@@ -102,7 +138,8 @@ class Cmd:
         self._active = True  # main()の終了条件に使用
 
         self._cmd = {}
-        self.add_cmd('sleep', self.cmd_i_sleep, self.cmd_q_sleep, 'sleep')
+        self.add_cmd('sleep', self.cmd_i_sleep, self.cmd_q_sleep, 'sleep',
+                     concurrent=True)
         self.add_cmd(self.CMD_HELP, self.cmd_i_help, None, 'command help')
         self.add_cmd(self.CMD_EXIT, self.cmd_i_exit, None, 'disconnect')
         self.add_cmd(self.CMD_SHUTDOWN,
@@ -141,15 +178,12 @@ class Cmd:
         self._active = False
         self._log.debug('done')
 
-    def add_cmd(self, name, func_i, func_q, help_str):
-        self._log.debug('name=%a, func_i=%a, func_q=%a, help_str=%a',
-                           name, func_i, func_q, help_str)
+    def add_cmd(self, name, func_i, func_q, help_str, concurrent=False):
+        self._log.debug('name=%a, func_i=%a, func_q=%a, help_str=%a, '
+                        'concurrent=%s',
+                        name, func_i, func_q, help_str, concurrent)
 
-        self._cmd[name] = {
-            'func_i': func_i,
-            'func_q': func_q,
-            self.HELP_STR: help_str
-        }
+        self._cmd[name] = CmdEntry(func_i, func_q, help_str, concurrent)
 
     def cmd_i_help(self, args):
         """
@@ -159,7 +193,7 @@ class Cmd:
 
         if len(args) >= 2:
             if args[1] in self._cmd:
-                msg = self._cmd[args[1]]['help']
+                msg = self._cmd[args[1]].help
                 rc = self.RC_OK
                 return rc, msg
             else:
@@ -170,7 +204,7 @@ class Cmd:
         # command list
         msg = []
         for c in self._cmd:
-            msg.append([c, self._cmd[c]['help']])
+            msg.append([c, self._cmd[c].help])
 
         rc = self.RC_OK
         return rc, msg
@@ -274,11 +308,26 @@ class Cmd:
         return rc, msg
 
 
+# msg なしリプライの送信データ (rc -> bytes)
+_REPLY_NOMSG = {
+    rc: json.dumps({'rc': rc}).encode('utf-8') + _CRLF + _EOF
+    for rc in (Cmd.RC_OK, Cmd.RC_NG, Cmd.RC_CONT, Cmd.RC_ACCEPT, Cmd.RC_NONE)
+}
+
+# 接続数が上限を超えた場合のリプライ (CmdServer.process_request())
+_REPLY_BUSY = json.dumps({'rc': Cmd.RC_NG, 'msg': 'server busy'}).encode(
+    'utf-8') + _CRLF + _EOF
+
+
 class CmdServerHandler(socketserver.StreamRequestHandler):
     """
     override 不要
     """
-    DEF_HANDLE_TIMEOUT = 3  # sec
+    # None: タイムアウトなし
+    # (サーバー終了時は、CmdServer.end()がソケットを shutdownする)
+    DEF_HANDLE_TIMEOUT = None  # sec
+    RECV_BUFSIZE = 65536  # bytes
+    MAX_LINE_LEN = 65536  # bytes: 改行のないコマンドの上限
 
     EOF = '\x04'
 
@@ -290,7 +339,6 @@ class CmdServerHandler(socketserver.StreamRequestHandler):
         self._svr = svr
 
         self._active = False
-        self._myq = queue.SimpleQueue()
 
         # 変数名は固定: self.request.recv() のタイムアウト
         self.timeout = self.DEF_HANDLE_TIMEOUT
@@ -301,6 +349,17 @@ class CmdServerHandler(socketserver.StreamRequestHandler):
     def setup(self):
         self._log.debug('_active=%s', self._active)
         self._active = True
+        # 小さなリプライを Nagle で待たせない
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._rxbuf = bytearray()  # 受信バッファ
+        self._framed = False  # True: 改行区切りのクライアント
+        self._cmdtbl = self._svr._app._cmd._cmd  # コマンドテーブル
+        self._cmdq = self._svr._app._cmdq
+
+        # func_q の結果の受け取り用 (cmd_worker()が set_reply()で設定)
+        self._rep_evt = threading.Event()
+        self._rep_val = None
+
         self._log.debug('_active=%s', self._active)
         return super().setup()
 
@@ -310,178 +369,283 @@ class CmdServerHandler(socketserver.StreamRequestHandler):
         self._log.debug('_active=%s', self._active)
         return super().finish()
 
+    def set_reply(self, rc, msg):
+        """
+        func_q の結果を渡して、handle()を再開させる
+        """
+        self._rep_val = (rc, msg)
+        self._rep_evt.set()
+
     def set_timeout(self, timeout=DEF_HANDLE_TIMEOUT):
         self._dbg('timeout=%s', timeout)
         self.timeout = timeout
 
     def net_write(self, msg, enc='utf-8'):
-        self._log.debug('msg=%a, enc=%s', msg, enc)
+        if self._dbg:
+            self._log.debug('msg=%a, enc=%s', msg, enc)
 
         if enc != '':
             msg = msg.encode(enc)
-            self._log.debug('msg=%a', msg)
 
         try:
             self.wfile.write(msg)
         except Exception as e:
             self._log.warning('%s:%s.', type(e), e)
 
+    def send_reply_const(self, rep):
+        """
+        作成済みの送信データ(bytes)を、そのまま送信する
+        """
+        self.net_write(rep, enc='')
+
     def send_reply(self, rc, msg=None, cont=False):
-        self._log.debug('rc=%a, msg=%a, cont=%s', rc, msg, cont)
+        if self._dbg:
+            self._log.debug('rc=%a, msg=%a, cont=%s', rc, msg, cont)
+
+        if msg is None and not cont and rc in _REPLY_NOMSG:
+            self.send_reply_const(_REPLY_NOMSG[rc])
+            return
+
+        if _is_json_plain(rc) and (msg is None or _is_json_plain(msg)):
+            # json.dumps()と同じ形式の文字列を直接作る
+            if msg is None:
+                rep_str = '{"rc": "%s"}' % rc
+            else:
+                rep_str = '{"rc": "%s", "msg": "%s"}' % (rc, msg)
+        else:
+            if msg is None:
+                rep = {'rc': rc}
+            else:
+                rep = {'rc': rc, 'msg': msg}
+            rep_str = json.dumps(rep)
 
-        if msg is None:
-            rep = {'rc': rc}
+        # 一つの bytesにまとめて、一度に送信する
+        payload = rep_str.encode('utf-8')
+        if cont:
+            self.net_write(b''.join((payload, _CRLF)), enc='')
         else:
-            rep = {'rc': rc, 'msg': msg}
-        rep_str = json.dumps(rep)
-        rep_str += '\r\n'
-        if not cont:
-            rep_str += self.EOF
-        self._log.debug('rep_str=%a', rep_str)
-        self.net_write(rep_str)
+            self.net_write(b''.join((payload, _CRLF, _EOF)), enc='')
 
     def handle(self):
         self._log.debug('')
 
+        # ループ内で使うものは、ローカル変数に入れておく
+        log = self._log
+        dbg = self._dbg
+        recv = self.request.recv
+        bufsize = self.RECV_BUFSIZE
+        rxbuf = self._rxbuf
+        cmdtbl = self._cmdtbl
+        cmdq = self._cmdq
+        send = self.send_reply
+        rep_evt = self._rep_evt
+
         while self._active:
-            self._log.debug('wait net_data')
             try:
                 # in_data = self.rfile.readline().strip()
                 #                ↓
                 # rfile だと、一度タイムアウトすると、
                 # 二度と読めない!?
                 #              ↓
-                in_data = self.request.recv(512).strip()
+                in_data = recv(bufsize)
 
             except socket.timeout as e:
-                self._log.debug('%s:%s.', type(e), e)
-                self._log.debug('_svr._active=%s', self._svr._active)
+                log.debug('%s:%s.', type(e), e)
+                log.debug('_svr._active=%s', self._svr._active)
                 if self._svr._active:
                     # サーバーが生きている場合は、継続
                     continue
                 else:
-                    self.send_reply(Cmd.RC_NG, 'server is dead !')
+                    send(Cmd.RC_NG, 'server is dead !')
                     break
             except Exception as e:
-                self._log.warning('%s:%s.', type(e), e)
+                log.warning('%s:%s.', type(e), e)
                 msg = 'error %s:%s' % (type(e), e)
-                self.send_reply(Cmd.RC_NG, msg)
+                send(Cmd.RC_NG, msg)
                 break
-            else:
-                self._log.debug('in_data=%a', in_data)
 
-            if len(in_data) == 0 or in_data == b'\x04':
-                self._log.debug('disconnected')
+            if len(in_data) == 0:
+                log.debug('disconnected')
                 break
 
-            # decode
-            try:
-                decoded_data = in_data.decode('utf-8')
-            except UnicodeDecodeError as e:
-                msg = '%s:%s .. ignored' % (type(e), e)
-                self._log.error(msg)
-                self.send_reply(Cmd.RC_NG, msg)
-                break
-            else:
-                self._log.debug('decoded_data=%a', decoded_data)
-
-            # get args
-            args = decoded_data.split()
-            self._log.debug('args=%s', args)
-            if len(args) == 0:
-                msg = 'no command'
-                self._log.warning(msg)
-                self.send_reply(Cmd.RC_NG, msg)
-                break
+            rxbuf.extend(in_data)
+            if not self._framed and b'\n' in in_data:
+                self._framed = True
 
-            # check command
-            if args[0] not in self._svr._app._cmd._cmd:
-                msg = '%s: no such command .. ignored' % args[0]
-                self._log.error(msg)
-                self.send_reply(Cmd.RC_NG, msg)
-                continue
+            # 受信データから、コマンドを一つずつ取り出して処理する
+            # (改行区切り)
+            #
+            # 改行を送ってこないクライアント(一回の送信で一コマンド)の
+            # 場合は、受信データ全体を一つのコマンドとみなす。
+            # 一度でも改行を受信したら、改行のない末尾は、
+            # 次の受信データの先頭とつなげるため、バッファに残す。
+            # (ただし、EOF だけの場合は、そのまま処理する)
+            while self._active and len(rxbuf) > 0:
+                idx = rxbuf.find(b'\n')
+                if idx < 0:
+                    if self._framed and rxbuf.strip() != _EOF:
+                        if len(rxbuf) > self.MAX_LINE_LEN:
+                            msg = 'line too long (> %d bytes)' % (
+                                self.MAX_LINE_LEN)
+                            log.error(msg)
+                            send(Cmd.RC_NG, msg)
+                            self._active = False
+                        break
+                    idx = len(rxbuf)
+                cmd_data = bytes(rxbuf[:idx]).strip()
+                del rxbuf[:idx + 1]
+
+                if len(cmd_data) == 0 or cmd_data == _EOF:
+                    log.debug('disconnected')
+                    self._active = False
+                    break
 
-            if self._svr._app._cmd._cmd[args[0]]['func_i'] is not None:
-                #
-                # interactive command
-                #
-                self._log.info('call func_i: %a', args)
-                rc, msg = self._svr._app._cmd._cmd[args[0]]['func_i'](args)
-                self._log.info('rc=%s, msg=%s', rc, msg)
+                # decode
+                try:
+                    decoded_data = cmd_data.decode('utf-8')
+                except UnicodeDecodeError as e:
+                    msg = '%s:%s .. ignored' % (type(e), e)
+                    log.error(msg)
+                    send(Cmd.RC_NG, msg)
+                    self._active = False
+                    break
 
-                if args[0] == Cmd.CMD_EXIT:
+                # get command name
+                # (引数の分割は、コマンドが見つかってから)
+                parts = decoded_data.split(None, 1)
+                if len(parts) == 0:
+                    msg = 'no command'
+                    log.warning(msg)
+                    send(Cmd.RC_NG, msg)
                     self._active = False
-                    self._log.debug('_active=%s', self._active)
+                    break
 
-                if rc != Cmd.RC_CONT and rc != Cmd.RC_ACCEPT:
-                    self.send_reply(rc, msg)
-                    continue
+                cmd_name = parts[0]
+                rest = parts[1] if len(parts) > 1 else ''
 
-                if rc == Cmd.RC_ACCEPT:
-                    self._myq = None
+                # check command
+                entry = cmdtbl.get(cmd_name)
+                if entry is None:
+                    msg = '%s: no such command .. ignored' % cmd_name
+                    log.error(msg)
+                    send(Cmd.RC_NG, msg)
+                    continue
 
-            # check FANC_Q
-            if self._svr._app._cmd._cmd[args[0]]['func_q'] is None:
-                msg2 = '%s: func_q is None .. ignored' % (args[0])
-                self._log.warning(msg2)
-                if msg is None:
-                    self.send_reply(Cmd.RC_OK, msg2)
+                # get args
+                if len(rest) == 0:
+                    args = [cmd_name]
                 else:
-                    self.send_reply(Cmd.RC_OK, msg)
-                continue
+                    args = [cmd_name] + rest.split()
+
+                repq = self  # 結果の返信先 (None: 返信しない)
+
+                if entry.func_i is not None:
+                    #
+                    # interactive command
+                    #
+                    log.info('call func_i: %a', args)
+                    rc, msg = entry.func_i(args)
+                    log.info('rc=%s, msg=%s', rc, msg)
+
+                    if cmd_name == Cmd.CMD_EXIT:
+                        self._active = False
+                        log.debug('_active=%s', self._active)
+
+                    if rc != Cmd.RC_CONT and rc != Cmd.RC_ACCEPT:
+                        send(rc, msg)
+                        continue
+
+                    if rc == Cmd.RC_ACCEPT:
+                        repq = None
+
+                # check FANC_Q
+                if entry.func_q is None:
+                    msg2 = '%s: func_q is None .. ignored' % (cmd_name)
+                    log.warning(msg2)
+                    if msg is None:
+                        send(Cmd.RC_OK, msg2)
+                    else:
+                        send(Cmd.RC_OK, msg)
+                    continue
 
-            #
-            # queuing
-            #
+                #
+                # queuing
+                #
 
-            # check que size
-            qsize = self._svr._app._cmdq.qsize()
-            if qsize > 100:
-                msg = 'qsize=%d: server busy' % qsize
-                self._log.warning(msg)
-                self.send_reply(Cmd.RC_NG, msg)
-                continue
+                # put args to queue
+                # (キューが一杯(CMDQ_MAXSIZE)なら、queue.Full)
+                try:
+                    cmdq.put((args, repq), block=False)
+                except queue.Full:
+                    msg = 'server busy'
+                    log.warning(msg)
+                    send(Cmd.RC_NG, msg)
+                    continue
+                except Exception as e:
+                    msg = '%s:%s' % (type(e), e)
+                    log.error(msg)
+                    send(Cmd.RC_NG, msg)
+                    continue
 
-            # put args to queue
-            try:
-                self._svr._app._cmdq.put((args, self._myq), block=False)
-            except Exception as e:
-                msg = '%s:%s' % (type(e), e)
-                self._log.error(msg)
-                self.send_reply(Cmd.RC_NG, msg)
-                continue
-
-            # if _myq is None (RC_ACCEPT), send reply now
-            if self._myq is None:
-                self._log.debug('reply queue is None .. send reply')
-                self.send_reply(Cmd.RC_OK, msg)
-                continue
-
-            # wait result from _myq
-            self._log.debug('wait result')
-            rc, msg = self._myq.get()
-            if rc == Cmd.RC_OK:
-                self._log.debug('rc=%s, msg=%s', rc, msg)
-            else:
-                self._log.error('rc=%s, msg=%s', rc, msg)
+                # if repq is None (RC_ACCEPT), send reply now
+                if repq is None:
+                    if dbg:
+                        log.debug('reply queue is None .. send reply')
+                    send(Cmd.RC_OK, msg)
+                    continue
+
+                # wait result
+                if dbg:
+                    log.debug('wait result')
+                rep_evt.wait()
+                rc, msg = self._rep_val
+                rep_evt.clear()
+                if rc == Cmd.RC_OK:
+                    if dbg:
+                        log.debug('rc=%s, msg=%s', rc, msg)
+                else:
+                    log.error('rc=%s, msg=%s', rc, msg)
 
-            # send reply
-            self.send_reply(rc, msg)
+                # send reply
+                send(rc, msg)
 
         self._log.debug('done')
 
 
-class CmdServer(socketserver.ThreadingTCPServer):
+class CmdServer(socketserver.TCPServer):
     """
     override 不要
+
+    接続ごとにスレッドを生成せず、
+    上限(max_handlers)付きのスレッドプールで CmdServerHandler を実行する。
+    各接続は、切断されるまでスレッドを占有するので、
+    max_handlers は、同時接続数の上限になる。
+    上限を超えた接続には、"server busy"(RC_NG)を返して、切断する。
+
+    reuse_port=True の場合、SO_REUSEPORT を設定し、
+    同じポートで複数のサーバープロセスを起動できるようにする。
+    (カーネルが接続を各プロセスに振り分ける)
+    ただし、Cmd, コマンドキューはプロセスごとに独立するので、
+    func_q の逐次実行は、プロセス内でのみ保証される。
     """
-    def __init__(self, app, port, debug=False):
+    DEF_MAX_HANDLERS = 64
+    request_queue_size = 128  # listen() backlog
+
+    def __init__(self, app, port, reuse_port=False,
+                 max_handlers=DEF_MAX_HANDLERS, debug=False):
         self._dbg = debug
         self._log = get_logger(__class__.__name__, self._dbg)
-        self._log.debug('port=%s', port)
+        self._log.debug('port=%s, reuse_port=%s, max_handlers=%s',
+                        port, reuse_port, max_handlers)
 
         self._app = app
         self._port = port
+        self._reuse_port = reuse_port
+        self._max_handlers = max_handlers
+
+        self._requests = set()  # 接続中のソケット (process_request()で登録)
+        self._handler_pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self._max_handlers, thread_name_prefix='handler')
 
         self._active = False
         self.allow_reuse_address = True  # Important !!
@@ -504,6 +668,61 @@ class CmdServer(socketserver.ThreadingTCPServer):
 
         self._log.debug('done')
 
+    def server_bind(self):
+        if self._reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
+
+    def process_request(self, request, client_address):
+        if len(self._requests) >= self._max_handlers:
+            # 空きスレッドがない: 待たせずに切断する
+            self._log.warning('%s: server busy .. disconnect',
+                              client_address)
+            try:
+                request.sendall(_REPLY_BUSY)
+            except OSError as e:
+                self._log.debug('%s:%s.', type(e), e)
+            self.shutdown_request(request)
+            return
+
+        # Handler のスレッドが動き出す前に登録しておく
+        # (end()で、すべての接続の recv()を終了させるため)
+        self._requests.add(request)
+        try:
+            fut = self._handler_pool.submit(self.process_request_thread,
+                                            request, client_address)
+            fut.add_done_callback(
+                functools.partial(self._request_cancelled, request))
+        except BaseException:
+            # submit()の途中で例外が発生した場合、スレッドが既に
+            # recv()で待っている可能性があるので、ここで終了させる
+            self._requests.discard(request)
+            try:
+                request.shutdown(socket.SHUT_RDWR)
+            except OSError as e:
+                self._log.debug('%s:%s.', type(e), e)
+            raise
+
+    def _request_cancelled(self, request, fut):
+        """
+        end()でキャンセルされ、開始しなかった接続を閉じる
+        """
+        if fut.cancelled():
+            self._requests.discard(request)
+            self.shutdown_request(request)
+
+    def process_request_thread(self, request, client_address):
+        """
+        ThreadingMixIn と同じ
+        """
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self._requests.discard(request)
+            self.shutdown_request(request)
+
     def serve_forever(self):
         self._log.debug('start')
         super().serve_forever()
@@ -520,23 +739,40 @@ class CmdServer(socketserver.ThreadingTCPServer):
         self._log.debug('')
         self.shutdown()  # serve_forever() を終了させる
         self._active = False  # handle()を終了させる
+
+        # 接続中の handle() の recv() を終了させる
+        for request in list(self._requests):
+            try:
+                request.shutdown(socket.SHUT_RDWR)
+            except OSError as e:
+                self._log.debug('%s:%s.', type(e), e)
+
+        self._handler_pool.shutdown(wait=False, cancel_futures=True)
         self._log.debug('done')
 
 
 class CmdServerApp:
     """
     """
+    CMDQ_MAXSIZE = 100  # func_q 待ちコマンド数の上限
+    FUNC_Q_WORKERS = 8  # concurrent な func_q を実行するスレッド数
+
     def __init__(self, cmd_class, init_param=None, port=Cmd.DEF_PORT,
-                 debug=False):
+                 reuse_port=False,
+                 max_handlers=CmdServer.DEF_MAX_HANDLERS, debug=False):
         self._dbg = debug
         self._log = get_logger(__class__.__name__, self._dbg)
-        self._log.debug('cmd_class=%s, init_param=%s, port=%s',
-                           cmd_class, init_param, port)
+        self._log.debug('cmd_class=%s, init_param=%s, port=%s, reuse_port=%s, '
+                        'max_handlers=%s',
+                        cmd_class, init_param, port, reuse_port, max_handlers)
 
-        self._cmdq = queue.Queue()
+        self._cmdq = queue.Queue(maxsize=self.CMDQ_MAXSIZE)
+        self._pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.FUNC_Q_WORKERS, thread_name_prefix='func_q')
 
         self._cmd = cmd_class(init_param, port, debug=self._dbg)
-        self._svr = CmdServer(self, self._cmd._port, self._dbg)
+        self._svr = CmdServer(self, self._cmd._port, reuse_port=reuse_port,
+                              max_handlers=max_handlers, debug=self._dbg)
         self._svr_th = threading.Thread(target=self._svr.serve_forever,
                                         daemon=True)
         self._cmd_worker_th = threading.Thread(target=self.cmd_worker,
@@ -552,17 +788,21 @@ class CmdServerApp:
             self._log.info('args=%a', args)
 
             # check and call cmd
-            if args[0] in self._cmd._cmd:
-                if self._cmd._cmd[args[0]]['func_q'] is not None:
+            entry = self._cmd._cmd.get(args[0])
+            if entry is not None:
+                if entry.func_q is not None and entry.concurrent:
+
+                    # call cmd in the pool (reply from callback)
+                    self._log.debug('submit func_q: %a', args)
+                    fut = self._pool.submit(self.call_func_q, entry, args)
+                    fut.add_done_callback(
+                        functools.partial(self.reply_func_q, args, repq))
+                    continue
 
-                    # call cmd
-                    self._log.debug('call func_q: %a', args)
-                    rc, msg = self._cmd._cmd[args[0]]['func_q'](args)
+                if entry.func_q is not None:
 
-                    if rc == Cmd.RC_OK:
-                        self._log.info('rc=%a, msg=%a', rc, msg)
-                    else:
-                        self._log.error('rc=%a, msg=%a', rc, msg)
+                    # call cmd
+                    rc, msg = self.call_func_q(entry, args)
                 else:
                     rc = Cmd.RC_NG
                     msg = '%s: no such func_q .. ignored' % (args[0])
@@ -573,8 +813,8 @@ class CmdServerApp:
                 self._log.error(msg)
 
             if repq is not None:
-                self._log.debug('put reply')
-                repq.put((rc, msg))
+                self._log.debug('set reply')
+                repq.set_reply(rc, msg)
 
             # shutdown check
             if args[0] == Cmd.CMD_SHUTDOWN:
@@ -582,11 +822,34 @@ class CmdServerApp:
                 time.sleep(1)
                 break
 
-            time.sleep(0.1)
-
         self._cmd.stop_main()
         self._log.debug('done')
 
+    def call_func_q(self, entry, args):
+        self._log.debug('call func_q: %a', args)
+        rc, msg = entry.func_q(args)
+
+        if rc == Cmd.RC_OK:
+            self._log.info('rc=%a, msg=%a', rc, msg)
+        else:
+            self._log.error('rc=%a, msg=%a', rc, msg)
+        return rc, msg
+
+    def reply_func_q(self, args, repq, fut):
+        """
+        並行実行した func_q の終了時に呼ばれ、結果を返信する
+        """
+        try:
+            rc, msg = fut.result()
+        except Exception as e:
+            rc = Cmd.RC_NG
+            msg = '%s: %s: %s' % (args[0], type(e), e)
+            self._log.error(msg)
+
+        if repq is not None:
+            self._log.debug('set reply')
+            repq.set_reply(rc, msg)
+
     def main(self):
         self._svr_th.start()
         self._cmd_worker_th.start()
@@ -601,7 +864,8 @@ class CmdServerApp:
             args, repq = self._cmdq.get()
             self._log.debug('args=%s, repq=%s', args, repq)
             if repq is not None:
-                repq.put((Cmd.RC_NG, 'terminated'))
+                repq.set_reply(Cmd.RC_NG, 'terminated')
+        self._pool.shutdown(wait=False, cancel_futures=True)
         self._svr.end()
         self._cmd.end()
         self._log.debug('done')
@@ -615,15 +879,24 @@ CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
                help='TCP Server base class')
 @click.option('--port', 'port', type=int,
               help='port number')
+@click.option('--reuse_port', 'reuse_port', is_flag=True, default=False,
+              help='set SO_REUSEPORT (run several server processes)')
+@click.option('--max_handlers', 'max_handlers', type=int,
+              default=CmdServer.DEF_MAX_HANDLERS,
+              help='max connections (default: %s)' % (
+                  CmdServer.DEF_MAX_HANDLERS))
 @click.option('--debug', '-d', 'debug', is_flag=True, default=False,
               help='debug flag')
-def main(port, debug):
+def main(port, reuse_port, max_handlers, debug):
     logger = get_logger(__name__, debug)
-    logger.debug('port=%s', port)
+    logger.debug('port=%s, reuse_port=%s, max_handlers=%s',
+                 port, reuse_port, max_handlers)
 
     logger.info('start')
 
-    app = CmdServerApp(Cmd, init_param=None, port=port, debug=debug)
+    app = CmdServerApp(Cmd, init_param=None, port=port,
+                       reuse_port=reuse_port, max_handlers=max_handlers,
+                       debug=debug)
     try:
         app.main()
     finally: